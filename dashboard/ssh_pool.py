@@ -0,0 +1,158 @@
+# Copyright (c) 2025, Julian Müller (ChaoticByte)
+
+
+import functools
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+from paramiko.channel import Channel
+from paramiko.client import SSHClient
+from paramiko.ssh_exception import SSHException
+from paramiko.pkey import PKey
+
+
+# Connections are kept open and reused for subsequent commands to the same
+# host, every command gets its own channel on the shared transport.
+
+
+# close connections that weren't used for that many seconds
+MAX_IDLE_TIME = 300
+REAPER_INTERVAL = 60
+# detect connections that died while idle
+KEEPALIVE_INTERVAL = 30
+# don't wait forever for a dead connection to open a channel
+CHANNEL_TIMEOUT = 10
+
+
+class _PoolEntry:
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.users = 0
+        self.last_used = time.time()
+
+    def is_active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+_entries: Dict[Tuple, _PoolEntry] = {}
+_lock = threading.Lock()
+_reaper: threading.Thread = None
+
+
+@functools.lru_cache(maxsize=32)
+def _load_pkey(key_file: str, passphrase: str) -> PKey:
+    # decrypting the key can take a while, so we only do that once
+    # passed positionally, the keyword was renamed in paramiko 5
+    return PKey.from_path(key_file, None if passphrase is None else passphrase.encode())
+
+
+def _connect(host: str, port: int, user: str, key_file: str, passphrase: str) -> SSHClient:
+    client = SSHClient()
+    client.load_system_host_keys()
+    if key_file is None:
+        # let paramiko try the ssh agent and the default keys
+        key_args = {"passphrase": passphrase}
+    else:
+        key_args = {"pkey": _load_pkey(key_file, passphrase)}
+    client.connect(
+        host, port=port,
+        username=user,
+        **key_args)
+    client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+    return client
+
+
+def _reap():
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        now = time.time()
+        with _lock:
+            for key, entry in list(_entries.items()):
+                if entry.users == 0 and (now - entry.last_used > MAX_IDLE_TIME or not entry.is_active()):
+                    del _entries[key]
+                    entry.client.close()
+
+
+def _start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_reap, name="ssh-pool-reaper", daemon=True)
+        _reaper.start()
+
+
+def _acquire(key: Tuple) -> Tuple[_PoolEntry, bool]:
+    # returns the entry and whether it's an existing connection
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and not entry.is_active():
+            # dead connection, evict it
+            del _entries[key]
+            entry.client.close()
+            entry = None
+        if entry is not None:
+            entry.users += 1
+            return entry, True
+    # connect outside of the lock, this can take a while
+    new_entry = _PoolEntry(_connect(*key))
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or not entry.is_active():
+            entry = _entries[key] = new_entry
+        else:
+            # someone else was faster
+            new_entry.client.close()
+        entry.users += 1
+        _start_reaper()
+    return entry, False
+
+
+def _release(entry: _PoolEntry):
+    with _lock:
+        entry.users -= 1
+        entry.last_used = time.time()
+
+
+def _evict(key: Tuple, entry: _PoolEntry):
+    with _lock:
+        if _entries.get(key) is entry:
+            del _entries[key]
+    entry.client.close()
+
+
+def _open_session(entry: _PoolEntry) -> Channel:
+    transport = entry.client.get_transport()
+    if transport is None:
+        raise SSHException("SSH session not active")
+    return transport.open_session(timeout=CHANNEL_TIMEOUT)
+
+
+@contextmanager
+def session(host: str, port: int, user: str, key_file: str, passphrase: str = None) -> Iterator[Channel]:
+    '''Yields a new channel on a connection for the given parameters,
+    reusing an existing connection if it's still alive.'''
+    key = (host, port, user, key_file, passphrase)
+    for attempt in range(2):
+        entry, reused = _acquire(key)
+        try:
+            chan = _open_session(entry)
+            break
+        except (SSHException, EOFError):
+            _release(entry)
+            if not reused or attempt > 0:
+                raise
+            # the connection died without us noticing (target rebooted,
+            # idle connection dropped by a NAT, ...), retry with a new one
+            _evict(key, entry)
+        except BaseException:
+            _release(entry)
+            raise
+    try:
+        with chan:
+            yield chan
+    finally:
+        _release(entry)
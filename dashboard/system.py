@@ -4,24 +4,42 @@
 # additional libraries
 
 
+import asyncio
+import functools
 import platform
-import re
+import select
 import socket
 import subprocess
+import threading
 import time
 
 from enum import Enum
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
+import httpx
+import icmplib
 import requests, urllib3
+from requests.adapters import HTTPAdapter
 from nicegui import ui
-from paramiko.client import SSHClient
-from paramiko.pkey import PKey
 
 
 # don't need the warning, bc. ssl verification needs to be disabled explicitly
 urllib3.disable_warnings(category=urllib3.connectionpool.InsecureRequestWarning)
 
+# shared session, so connections are kept alive between state updates
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0)
+_http_session.mount("http://", _http_adapter)
+_http_session.mount("https://", _http_adapter)
+
+# shared async clients for HTTPServer.update_state_async, one with and one
+# without certificate verification, as httpx can't set that per request
+_async_http_limits = httpx.Limits(max_connections=200)
+_async_http_clients = {
+    verify: httpx.AsyncClient(http2=True, verify=verify, timeout=1.0, limits=_async_http_limits)
+    for verify in (True, False)
+}
+
 
 # base classes and types and stuff
 
@@ -54,62 +72,172 @@ class SystemState(Enum):
 
 class System:
 
+    # state updates within that many seconds after the last one are skipped,
+    # can be set per class or instance for systems that are expensive to query
+    # (this also delays the update when a browser tab becomes visible again,
+    # and values above the ui's update interval throttle the regular updates)
+    min_update_interval: float = 0.0
+
     def __init__(self, name: str, description: str):
         self.name = name
         self.description = description
         self.state = SystemState.UNKNOWN
         self.state_verbose = ""
         self.last_update = 0
+        # held while an update is running, so overlapping updates are skipped
+        self._update_lock = threading.Lock()
+        # called after every completed update,
+        # not necessarily from the main thread
+        self.change_listeners: List[Callable[[], None]] = []
 
     def get_actions(self) -> List[Action]:
         # to be overridden
         return []
 
-    def _update_state(self):
-        self.update_state()
+    def _begin_update(self) -> bool:
+        if time.time() - self.last_update < self.min_update_interval:
+            return False
+        # skip if another update is still running
+        return self._update_lock.acquire(blocking=False)
+
+    def _updated(self):
         self.last_update = time.time()
+        self._update_lock.release()
+        # copy, listeners may be added or removed meanwhile
+        for listener in list(self.change_listeners):
+            listener()
+
+    def _update_state(self):
+        if not self._begin_update():
+            return
+        try:
+            self.update_state()
+        finally:
+            self._updated()
+
+    async def _update_state_async(self):
+        if not self._begin_update():
+            return
+        try:
+            await self.update_state_async()
+        finally:
+            self._updated()
 
     def update_state(self):
         # to be overridden
         self.state = SystemState.UNKNOWN
         self.state_verbose = ""
 
+    async def update_state_async(self):
+        # can be overridden if the system can update its state without blocking,
+        # by default, update_state is run in a worker thread
+        await asyncio.to_thread(self.update_state)
+
 
 # Mixins
 
 
+# unprivileged ICMP sockets may not be allowed on this system
+# (see net.ipv4.ping_group_range), we fall back to the ping executable then
+_icmp_sockets_allowed = True
+
+_ICMP_PING_ARGS = {"count": 1, "timeout": 1, "privileged": False}
+_ICMP_ERRORS = (icmplib.NameLookupError, icmplib.SocketPermissionError)
+
+_PING_COUNT_FLAG = "-n" if platform.system().lower() == "windows" else "-c"
+_PING_CMD = ("ping", _PING_COUNT_FLAG, "1")
+
 class PingableMixin:
 
+    ''' requires the following attributes:
+        - self.host: str    Host ip address
+    ping() and ping_async() return (ok, output, error output)
+    '''
+
     def ping(self) -> Tuple[bool, str, str]:
-        ''' requires the following attributes:
-            - self.host: str    Host ip address
-        '''
-        if platform.system().lower() == "windows": p = "-n"
-        else: p = "-c"
+        if _icmp_sockets_allowed:
+            try:
+                return self._icmp_result(icmplib.ping(self.host, **_ICMP_PING_ARGS))
+            except _ICMP_ERRORS as e:
+                result = self._icmp_error_result(e)
+                if result is not None:
+                    return result
         s = subprocess.run(
-            ["ping", p, '1', self.host],
+            _PING_CMD + (self.host,),
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             env={"LC_ALL": "C"} # don't translate
         )
-        return s.returncode == 0, s.stdout.decode(), s.stderr.decode()
-
+        return self._ping_cmd_result(s.returncode, s.stdout, s.stderr)
+
+    async def ping_async(self) -> Tuple[bool, str, str]:
+        if _icmp_sockets_allowed:
+            try:
+                return self._icmp_result(await icmplib.async_ping(self.host, **_ICMP_PING_ARGS))
+            except _ICMP_ERRORS as e:
+                result = self._icmp_error_result(e)
+                if result is not None:
+                    return result
+        proc = await asyncio.create_subprocess_exec(
+            *_PING_CMD, self.host,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env={"LC_ALL": "C"} # don't translate
+        )
+        stdout, stderr = await proc.communicate()
+        return self._ping_cmd_result(proc.returncode, stdout, stderr)
+
+    def _icmp_error_result(self, e: Exception) -> Optional[Tuple[bool, str, str]]:
+        # returns None if the ping executable should be used instead
+        global _icmp_sockets_allowed
+        if isinstance(e, icmplib.SocketPermissionError):
+            _icmp_sockets_allowed = False
+            return None
+        return False, "", str(e)
+
+    def _icmp_result(self, h: icmplib.Host) -> Tuple[bool, str, str]:
+        if h.is_alive:
+            return True, f"Ping: {h.avg_rtt} ms", ""
+        return False, "", f"No reply from {self.host}"
+
+    def _ping_cmd_result(self, returncode: int, stdout: bytes, stderr: bytes) -> Tuple[bool, str, str]:
+        if returncode == 0:
+            # find the first "time=... ms"
+            i = stdout.find(b"time=")
+            j = stdout.find(b" ms", i) if i >= 0 else -1
+            if j >= 0:
+                return True, f"Ping: {stdout[i+5:j].decode()} ms", ""
+        return returncode == 0, stdout.decode(), stderr.decode()
+
+
+@functools.cache
+def _broadcast_socket() -> socket.socket:
+    # opened on first use and then reused
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return s
+
+_WOL_STRIP = str.maketrans('', '', ':-')
+
+def magic_packet(host_mac: str) -> bytes:
+    host_mac_bin = bytes.fromhex(host_mac.translate(_WOL_STRIP))
+    if len(host_mac_bin) != 6:
+        raise ValueError(f"Invalid mac address: {host_mac}")
+    return (b'\xff' * 6) + (host_mac_bin * 16)
 
 class WakeOnLanMixin:
 
+    @functools.cached_property
+    def _magic_packet(self) -> bytes:
+        return magic_packet(self.host_mac)
+
     def wakeonlan(self):
         ''' requires the following attributes:
             - self.name: str        System.name
             - self.host_mac: str    host mac address
         '''
-        assert hasattr(self, "host_mac")
-        assert hasattr(self, "name")
-        host_mac_bin = bytes.fromhex(self.host_mac.replace(':', '').replace('-', '').lower())
-        magic_packet = (b'\xff' * 6) + (host_mac_bin * 16)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            for port in [7, 9]: # we send to both port 7 and 9 to be compatible with most of the systems
-                s.sendto(magic_packet, ("255.255.255.255", port))
-            ui.notify(f"Magic packet sent to wake up '{self.name}' ({self.host_mac})")
+        sock = _broadcast_socket()
+        for port in [7, 9]: # we send to both port 7 and 9 to be compatible with most of the systems
+            sock.sendto(self._magic_packet, ("255.255.255.255", port))
+        ui.notify(f"Magic packet sent to wake up '{self.name}' ({self.host_mac})")
 
 
 class SSHMixin:
@@ -123,53 +251,90 @@ class SSHMixin:
         - self.ssh_key_file
         - self.ssh_key_passphrase   Can be None
         - self.ssh_port
+        - self.ssh_run_all          Optional, adds a "Run all" action
     '''
 
-    def ssh_exec(self, action_name: str, cmd: str):
-        ui.notify(f"Executing '{action_name}' on {self.name} ({self.host}) via SSH")
-        with SSHClient() as client:
-            client.load_system_host_keys()
-            client.connect(
-                self.host, port=self.ssh_port,
-                username=self.ssh_user,
-                key_filename=self.ssh_key_file, passphrase=self.ssh_key_passphrase)
-            chan = client.get_transport().open_session()
+    def _ssh_run(self, cmd: str):
+        # paramiko takes a while to import, so we only do that when it's needed
+        from . import ssh_pool
+        with ssh_pool.session(
+            self.host, self.ssh_port,
+            self.ssh_user,
+            self.ssh_key_file, self.ssh_key_passphrase
+        ) as chan:
             chan.set_combine_stderr(True)
             chan.exec_command(cmd)
-            last_output_chunk = ""
-            while not chan.exit_status_ready(): # if we don't do that, we might deadlock
-                last_output_chunk = chan.recv(1024)
+            output = bytearray()
+            # we have to read the output, if we don't do that, we might deadlock
+            while True:
+                if chan.recv_ready():
+                    output += chan.recv(65536)
+                elif chan.exit_status_ready():
+                    break
+                else:
+                    select.select([chan], [], [], 1.0)
             if not chan.exit_status == 0:
-                raise Exception(f"Exit status is {chan.exit_status}, last stdout: {last_output_chunk.decode()}")
+                raise Exception(f"Exit status is {chan.exit_status}, output: {output.decode(errors='replace').strip()}")
+
+    def ssh_exec(self, action_name: str, cmd: str):
+        ui.notify(f"Executing '{action_name}' on {self.name} ({self.host}) via SSH")
+        self._ssh_run(cmd)
+
+    def ssh_exec_many(self, actions: List[Tuple[str, str]]):
+        '''Executes multiple (action name, command) pairs in a single SSH session,
+        stops at the first command that fails.'''
+        action_names = ", ".join(f"'{name}'" for name, _ in actions)
+        ui.notify(f"Executing {action_names} on {self.name} ({self.host}) via SSH")
+        # the newline ends a possible trailing comment in cmd
+        self._ssh_run(" && ".join(f"({cmd}\n)" for _, cmd in actions))
 
     def actions_from_ssh_commands(self):
-        return [Action(name, self.ssh_exec, name, cmd) for name, cmd in self.ssh_commands.items()]
+        actions = [Action(name, self.ssh_exec, name, cmd) for name, cmd in self.ssh_commands.items()]
+        if getattr(self, "ssh_run_all", False) and len(self.ssh_commands) > 1:
+            actions.append(Action("Run all", self.ssh_exec_many, list(self.ssh_commands.items())))
+        return actions
 
 
 # Pingable System
 
 
-ping_time_regex = re.compile(r".*ttl=\d+ time=((?:\d+\.)?\d+ ms).*")
-
 class PingableSystem(PingableMixin, System):
 
     def __init__(self, name, description, host: str):
         super().__init__(name, description)
         self.host = host
+        self._actions_cache: Dict[SystemState, Tuple[Action, ...]] = {}
+
+    def get_actions(self) -> List[Action]:
+        # the actions of pingable systems only depend on the state
+        actions = self._actions_cache.get(self.state)
+        if actions is None:
+            actions = self._actions_cache[self.state] = tuple(self._compute_actions())
+        # a copy, so subclasses can extend the list without changing the cache
+        return list(actions)
+
+    def _compute_actions(self) -> List[Action]:
+        # to be overridden instead of get_actions
+        return []
+
+    def _apply_ping_result(self, ok: bool, stdout: str, stderr: str):
+        if ok:
+            self.state = SystemState.OK
+            self.state_verbose = stdout.strip("\n\r ")
+        else:
+            self.state = SystemState.FAILED
+            self.state_verbose = (stdout + "\n" + stderr).strip("\n\r ")
 
     def update_state(self):
         try:
-            ok, stdout, stderr = self.ping()
-            if ok:
-                self.state = SystemState.OK
-                p_matches = ping_time_regex.findall(stdout)
-                if len(p_matches) > 0:
-                    self.state_verbose = f"Ping: {p_matches[0]}"
-                else:
-                    self.state_verbose = stdout.strip("\n\r ")
-            else:
-                self.state = SystemState.FAILED
-                self.state_verbose = (stdout + "\n" + stderr).strip("\n\r ")
+            self._apply_ping_result(*self.ping())
+        except Exception as e:
+            self.state = SystemState.UNKNOWN
+            self.state_verbose = f"Exception: {str(e)}"
+
+    async def update_state_async(self):
+        try:
+            self._apply_ping_result(*await self.ping_async())
         except Exception as e:
             self.state = SystemState.UNKNOWN
             self.state_verbose = f"Exception: {str(e)}"
@@ -185,8 +350,9 @@ class PingableWOLSystem(WakeOnLanMixin, PingableSystem):
     def __init__(self, name, description, host_ip: str, host_mac: str):
         super().__init__(name, description, host_ip)
         self.host_mac = host_mac
+        self._magic_packet # invalid mac addresses fail here already
 
-    def get_actions(self) -> List[Action]:
+    def _compute_actions(self) -> List[Action]:
         actions = []
         if self.state != SystemState.OK:
             actions.append(Action("Wake On LAN", self.wakeonlan))
@@ -206,6 +372,7 @@ class SSHControllablePingableSystem(SSHMixin, PingableSystem):
         ssh_key_file: str,
         ssh_key_passphrase: str = None,
         ssh_port: int = 22,
+        ssh_run_all: bool = False, # add an action that runs all commands in order
     ):
         super().__init__(name, description, host_ip)
         self.host = host_ip
@@ -214,9 +381,10 @@ class SSHControllablePingableSystem(SSHMixin, PingableSystem):
         self.ssh_key_file = ssh_key_file
         self.ssh_key_passphrase = ssh_key_passphrase
         self.ssh_port = ssh_port
+        self.ssh_run_all = ssh_run_all
 
-    def get_actions(self) -> List[Action]:
-        actions = super().get_actions()
+    def _compute_actions(self) -> List[Action]:
+        actions = super()._compute_actions()
         if not self.state == SystemState.FAILED:
             actions.extend(self.actions_from_ssh_commands())
         return actions
@@ -235,6 +403,7 @@ class SSHControllablePingableWOLSystem(WakeOnLanMixin, SSHControllablePingableSy
         ssh_key_file: str,
         ssh_key_passphrase: str = None,
         ssh_port: int = 22,
+        ssh_run_all: bool = False, # add an action that runs all commands in order
     ):
         super().__init__(
             name, description, host_ip,
@@ -242,13 +411,15 @@ class SSHControllablePingableWOLSystem(WakeOnLanMixin, SSHControllablePingableSy
             ssh_user=ssh_user,
             ssh_key_file=ssh_key_file,
             ssh_key_passphrase=ssh_key_passphrase,
-            ssh_port=ssh_port
+            ssh_port=ssh_port,
+            ssh_run_all=ssh_run_all
         )
         self.host_mac = host_mac
+        self._magic_packet # invalid mac addresses fail here already
 
 
-    def get_actions(self) -> List[Action]:
-        actions = super().get_actions()
+    def _compute_actions(self) -> List[Action]:
+        actions = super()._compute_actions()
         if self.state != SystemState.OK:
             actions.append(Action("Wake On LAN", self.wakeonlan))
         return actions
@@ -269,17 +440,34 @@ class HTTPServer(System):
         self.expected_status = expected_status_code
         self.allow_self_signed_cert = allow_self_signed_cert
 
+    def _apply_response(self, status_code: int, url: str):
+        if status_code == self.expected_status:
+            self.state = SystemState.OK
+        else:
+            self.state = SystemState.FAILED
+        self.state_verbose = f"Status {status_code} {url}"
+
     def update_state(self):
         try:
-            r = requests.head(self.url, timeout=1.0, verify=not self.allow_self_signed_cert)
-            if r.status_code == self.expected_status:
-                self.state = SystemState.OK
-            else:
-                self.state = SystemState.FAILED
-            self.state_verbose = f"Status {r.status_code} {r.url}"
+            r = _http_session.head(
+                self.url, timeout=1.0,
+                verify=not self.allow_self_signed_cert,
+                allow_redirects=False)
+            self._apply_response(r.status_code, r.url)
         except requests.ConnectionError as e:
             self.state = SystemState.FAILED
             self.state_verbose = f"Connection failed: {str(e)}"
         except Exception as e:
             self.state = SystemState.UNKNOWN
             self.state_verbose = f"Exception: {str(e)}"
+
+    async def update_state_async(self):
+        try:
+            r = await _async_http_clients[not self.allow_self_signed_cert].head(self.url)
+            self._apply_response(r.status_code, r.url)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            self.state = SystemState.FAILED
+            self.state_verbose = f"Connection failed: {str(e)}"
+        except Exception as e:
+            self.state = SystemState.UNKNOWN
+            self.state_verbose = f"Exception: {str(e)}"
@@ -4,65 +4,221 @@
 import asyncio
 import datetime
 
-from typing import List
+from typing import List, Tuple
 from .system import Action, System, SystemState
 
-from nicegui import ui, html, run
+from nicegui import context, core, events, ui, html
+
+
+# max. number of systems that are updated concurrently
+UPDATE_CONCURRENCY = 32
+update_state_semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+STATE_COLORS = {
+    SystemState.OK: "limegreen",
+    SystemState.FAILED: "red",
+}
+
+VISIBILITY_SCRIPT = """<script>
+function reportVisibility() {
+    emitEvent("visibility", {tab: window.documentId, hidden: document.hidden});
+}
+document.addEventListener("visibilitychange", reportVisibility);
+</script>"""
+# time the remaining tabs get to report their visibility after a tab was closed
+VISIBILITY_REPORT_TIMEOUT = 2.0
+
+
+class SystemCard:
+
+    '''The card of a system. Elements are created once,
+    apply_state() only updates those affected by a state change.'''
+
+    def __init__(self, system: System):
+        self.system = system
+        self.card = ui.card().style("width: 30rem; max-width: 95vw;")
+        with self.card:
+            with ui.row(align_items="center").classes("w-full"):
+                ui.label(system.name).classes("text-xl font-medium text-wrap")
+                ui.space()
+                self.time_label = ui.label().classes("opacity-25 text-xs")
+            if system.description != "":
+                ui.label(system.description).classes("opacity-75 text-wrap")
+            with html.pre().classes("opacity-50 text-xs text-wrap break-all") as self.verbose:
+                self.verbose_label = ui.label()
+            self.separator = ui.separator().style("margin-top: auto;")
+            self.actions: List[Action] = []
+            self.action_buttons = ui.refreshable(self._action_buttons)
+            self.action_buttons()
+        self._apply_last_update()
+        self._apply_border()
+        self._apply_verbose()
+        self._apply_actions()
+        self.rendered_state = self._state()
+        system.change_listeners.append(self._on_change)
+
+    def detach(self):
+        '''Stops pushing state changes to this card.'''
+        if self._on_change in self.system.change_listeners:
+            self.system.change_listeners.remove(self._on_change)
+
+    def _on_change(self):
+        # state updates may run in a worker thread
+        core.loop.call_soon_threadsafe(self._apply_pushed_state)
+
+    def _apply_pushed_state(self):
+        if self.card.is_deleted:
+            # the card was removed without being detached
+            self.detach()
+        else:
+            self.apply_state()
+
+    def _run_action(self, a: Action):
+        try:
+            a()
+        finally:
+            # actions may change the state directly
+            self.apply_state()
+
+    def _state(self) -> Tuple[SystemState, str, float]:
+        return self.system.state, self.system.state_verbose, self.system.last_update
+
+    def _apply_last_update(self):
+        self.time_label.text = datetime.datetime.fromtimestamp(self.system.last_update).strftime(r"%H:%M:%S")
+
+    def _apply_border(self):
+        color = STATE_COLORS.get(self.system.state, "dodgerblue")
+        self.card.style(f"border-left: 4px solid {color}")
+
+    def _apply_verbose(self):
+        self.verbose_label.text = self.system.state_verbose
+        self.verbose.set_visibility(self.system.state_verbose != "")
+
+    def _action_buttons(self):
+        if len(self.actions) > 0:
+            with ui.card_actions():
+                for i in range(len(self.actions)):
+                    # look the action up on click, so that the buttons
+                    # don't have to be recreated for new Action instances
+                    ui.button(text=self.actions[i].name, on_click=lambda i=i: self._run_action(self.actions[i]))
+
+    def _apply_actions(self):
+        t = self.system
+        actions = t.get_actions()
+        assert actions != None
+        for a in actions:
+            assert isinstance(a, Action)
+        # only recreate the buttons if the actions changed
+        changed = [a.name for a in actions] != [a.name for a in self.actions]
+        self.actions = actions
+        if changed:
+            self.action_buttons.refresh()
+        self.separator.set_visibility(len(actions) > 0 and (t.description != "" or t.state_verbose != ""))
+
+    def apply_state(self):
+        state = self._state()
+        if state == self.rendered_state:
+            return
+        if state[2] != self.rendered_state[2]:
+            self._apply_last_update()
+        if state[1] != self.rendered_state[1]:
+            self._apply_verbose()
+        if state[:2] != self.rendered_state[:2]:
+            self._apply_border()
+            self._apply_actions()
+        self.rendered_state = state
 
 
 def init_ui(
     systems: List[System],
-    ui_refresh_interval: float = 5,          # in seconds
+    ui_refresh_interval: float = 30,         # in seconds, fallback, updates are pushed to the ui anyway
     system_state_update_interval: float = 15 # in seconds
 ):
 
+    cards: List[SystemCard] = []
+
+    def render_system(t: System):
+        cards.append(SystemCard(t))
+
+    def render_heading(t: str):
+        ui.label(t).classes("text-2xl textmedium w-full text-center").style("margin-top: 1.5rem; margin-bottom: .5rem")
+
+    renderers = {"system": render_system, "heading": render_heading}
+
     @ui.refreshable
     def systems_list():
+        # only called again when systems are added or removed,
+        # state changes are applied to the existing cards
+        for c in cards:
+            c.detach()
+        cards.clear()
+        # sort out systems and headings once per structural change
+        items = [("system", t) if isinstance(t, System) else ("heading", t) for t in systems if isinstance(t, (System, str))]
         with ui.row(wrap=True).classes("justify-center items-stretch"):
-            for t in systems:
-                if isinstance(t, System):
-                    card = ui.card().style("width: 30rem; max-width: 95vw;")
-                    if t.state == SystemState.OK:
-                        card = card.style("border-left: 4px solid limegreen")
-                    elif t.state == SystemState.FAILED:
-                        card = card.style("border-left: 4px solid red")
-                    else:
-                        card = card.style("border-left: 4px solid dodgerblue")
-
-                    with card:
-                        with ui.row(align_items="center").classes("w-full"):
-                            ui.label(t.name).classes("text-xl font-medium text-wrap")
-                            ui.space()
-                            ui.label(datetime.datetime.fromtimestamp(t.last_update).strftime(r"%H:%M:%S")).classes("opacity-25 text-xs")
-                        if t.description != "":
-                            ui.label(t.description).classes("opacity-75 text-wrap")
-                        if t.state_verbose != "":
-                            html.pre(t.state_verbose).classes("opacity-50 text-xs text-wrap break-all")
-                        actions = t.get_actions()
-                        assert actions != None
-                        if len(actions) > 0:
-                            if t.description != "" or t.state_verbose != "":
-                                ui.separator().style("margin-top: auto;")
-                            with ui.card_actions():
-                                for a in actions:
-                                    assert isinstance(a, Action)
-                                    ui.button(text=a.name, on_click=a)
-                elif isinstance(t, str):
-                    ui.label(t).classes("text-2xl textmedium w-full text-center").style("margin-top: 1.5rem; margin-bottom: .5rem")
+            for kind, t in items:
+                renderers[kind](t)
+
+    def apply_states():
+        for c in cards:
+            c.apply_state()
 
     with ui.column(align_items="center").classes("w-full"):
         systems_list()
 
+    async def update_state(t: System):
+        async with update_state_semaphore:
+            await t._update_state_async()
+
     async def update_states():
-        coros = []
-        for t in systems:
-            if isinstance(t, System):
-                # we start all ...
-                coros.append(run.io_bound(t._update_state))
-        # ... and await later.
-        asyncio.gather(*coros)
-
-    ui.timer(system_state_update_interval, callback=update_states)
-    ui.timer(ui_refresh_interval, systems_list.refresh)
+        # we start all and wait for them to finish
+        await asyncio.gather(*[update_state(t) for t in systems if isinstance(t, System)])
+
+    state_timer = ui.timer(system_state_update_interval, callback=update_states)
+    refresh_timer = ui.timer(ui_refresh_interval, apply_states)
+
+    # pause the timers while no browser tab is visible
+
+    ui.add_head_html(VISIBILITY_SCRIPT)
+    visible_tabs = set()
+
+    async def set_timers_active():
+        active = len(visible_tabs) > 0
+        if active == state_timer.active:
+            return
+        state_timer.active = refresh_timer.active = active
+        if active:
+            # don't let the user wait for the next interval
+            await update_states()
+            apply_states()
+
+    async def on_visibility(e: events.GenericEventArguments):
+        if e.args["hidden"]:
+            visible_tabs.discard(e.args["tab"])
+        else:
+            visible_tabs.add(e.args["tab"])
+        await set_timers_active()
+
+    def on_connect():
+        # let the new tab report its visibility
+        client.run_javascript("reportVisibility()")
+
+    async def on_disconnect():
+        # we can't tell which tab was closed, so we forget all of them
+        visible_tabs.clear()
+        if client.shared:
+            # and let the remaining tabs report again
+            client.run_javascript("reportVisibility()")
+            await asyncio.sleep(VISIBILITY_REPORT_TIMEOUT)
+        else:
+            # the page is deleted, its cards don't need updates anymore
+            for c in cards:
+                c.detach()
+        await set_timers_active()
+
+    # registered on the client, so that init_ui can be used in page builders, too
+    client = context.client
+    ui.on("visibility", on_visibility)
+    client.on_connect(on_connect)
+    client.on_disconnect(on_disconnect)
 
     dark = ui.dark_mode(None) # auto